@@ -1,19 +1,49 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import argparse
-import json
+import atexit
 import os
-import re
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
-import requests
+import httpx
+import orjson
+import xxhash
+import zstandard as zstd
 
 TEAM_INFO_URL_TEMPLATE = "https://ctftime.org/api/v1/teams/{team_id}/"
 LEADERBOARD_URL_TEMPLATE = "https://ctftime.org/api/v1/top-by-country/{country}/"
 TEAM_PAGE_URL_TEMPLATE = "https://ctftime.org/team/{team_id}"
 
-LEADERBOARD_FILE = Path("leaderboard.json")
+LEADERBOARD_FILE = Path("leaderboard.json.zst")
+LEGACY_LEADERBOARD_FILE = Path("leaderboard.json")
+HTTP_CACHE_FILE = Path("leaderboard.etag.json")
+HASH_FILE = Path("leaderboard.hash")
+COUNTRY_CACHE_FILE = Path("team_country.json")
+
+# A team's country practically never changes, but re-check it once a week
+COUNTRY_CACHE_TTL = 7 * 24 * 60 * 60
+
+MARKDOWN_ESCAPES = str.maketrans({c: "\\" + c for c in r"\`*_{}[]()#+-.!"})
+
+# One client for every request so the CTFtime calls share a single HTTP/2 connection
+SESSION = httpx.Client(
+    http2=True,
+    timeout=30,
+    follow_redirects=True,
+    headers={"user-agent": "ctftime-vakta/1.0"},
+)
+atexit.register(SESSION.close)
+
+ZSTD_COMPRESSOR = zstd.ZstdCompressor(level=3)
+# Not thread safe, so only load_old_leaderboard (run once per process) may use it
+ZSTD_DECOMPRESSOR = zstd.ZstdDecompressor()
+
+# Returned by fetch_leaderboard on a 304, meaning the saved leaderboard is current
+NOT_MODIFIED = object()
 
 parser = argparse.ArgumentParser(
     description="Monitor CTFtime leaderboard for changes in a team's national ranking"
@@ -46,78 +76,257 @@ if not WEBHOOK_URL.startswith("https://stoat.chat/api/webhooks/"):
     sys.exit(1)
 
 
-def fetch_team_info(team_id: int):
+def load_http_cache():
+    if not HTTP_CACHE_FILE.exists():
+        return {}
+    try:
+        cache = orjson.loads(HTTP_CACHE_FILE.read_bytes())
+    except (orjson.JSONDecodeError, IOError) as e:
+        print(f"Ignoring unreadable HTTP cache file: {e}", file=sys.stderr)
+        return {}
+
+    if not isinstance(cache, dict):
+        print("Ignoring malformed HTTP cache file", file=sys.stderr)
+        return {}
+    return cache
+
+
+def save_http_cache(cache):
+    tmp = HTTP_CACHE_FILE.with_suffix(".json.tmp")
+    try:
+        tmp.write_bytes(orjson.dumps(cache, option=orjson.OPT_INDENT_2))
+        os.replace(tmp, HTTP_CACHE_FILE)
+    except IOError as e:
+        print(f"Failed to save HTTP cache: {e}", file=sys.stderr)
+
+
+def conditional_headers(entry, url):
+    headers = {}
+    # Anything but a well-formed entry (e.g. a hand-edited file) is a cache miss
+    if not isinstance(entry, dict) or entry.get("url") != url:
+        return headers
+
+    if isinstance(entry.get("etag"), str):
+        headers["If-None-Match"] = entry["etag"]
+    if isinstance(entry.get("last_modified"), str):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    return headers
+
+
+def cache_entry(response, url):
+    return {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def fetch_team_info(team_id: int, http_cache):
     url = TEAM_INFO_URL_TEMPLATE.format(team_id=team_id)
+    entry = http_cache.get("team_info")
+    has_body = isinstance(entry, dict) and isinstance(entry.get("body"), dict)
+    headers = conditional_headers(entry, url) if has_body else {}
 
     try:
-        response = requests.get(url, timeout=30)
-        if response.status_code == 404:
+        response = SESSION.get(url, headers=headers)
+        status = response.status_code
+        if status == 304:
+            return entry["body"]
+        if status == 404:
             print(f"Team with ID {TEAM_ID} not found", file=sys.stderr)
             sys.exit(1)
-        response.raise_for_status()
-        return response.json()
+        if not 200 <= status < 300:
+            print(f"Failed to fetch team info: HTTP {status}", file=sys.stderr)
+            sys.exit(1)
+        data = orjson.loads(response.content)
+
+        http_cache["team_info"] = {**cache_entry(response, url), "body": data}
+        return data
 
-    except requests.exceptions.RequestException as e:
+    except httpx.RequestError as e:
         print(f"Failed to fetch team info: {e}", file=sys.stderr)
         sys.exit(1)
 
+    except orjson.JSONDecodeError as e:
+        print(f"Failed to decode team info JSON: {e}", file=sys.stderr)
+        sys.exit(1)
+
 
-def fetch_leaderboard(api_url: str):
+def load_country_cache():
+    if not COUNTRY_CACHE_FILE.exists():
+        return {}
     try:
-        response = requests.get(api_url, timeout=30)
-        response.raise_for_status()
-        data = response.json()
+        return orjson.loads(COUNTRY_CACHE_FILE.read_bytes())
+    except (orjson.JSONDecodeError, IOError) as e:
+        print(f"Ignoring unreadable country cache file: {e}", file=sys.stderr)
+        return {}
 
-        for team in data:
-            team.pop("team_country", None)
-            team.pop("place", None)
 
-        return data
+def save_country_cache(cache):
+    tmp = COUNTRY_CACHE_FILE.with_suffix(".json.tmp")
+    try:
+        tmp.write_bytes(orjson.dumps(cache, option=orjson.OPT_INDENT_2))
+        os.replace(tmp, COUNTRY_CACHE_FILE)
+    except IOError as e:
+        print(f"Failed to save country cache: {e}", file=sys.stderr)
+
+
+def get_team_country(team_id: int, http_cache):
+    # Stored with an explicit timestamp, since a fresh checkout resets file mtimes
+    cache = load_country_cache()
+    if not isinstance(cache, dict):
+        cache = {}
+
+    # Anything but a well-formed entry (e.g. a hand-edited file) is a cache miss
+    entry = cache.get(str(team_id))
+    if (
+        isinstance(entry, dict)
+        and isinstance(entry.get("country"), str)
+        and isinstance(entry.get("fetched_at"), (int, float))
+        and time.time() - entry["fetched_at"] < COUNTRY_CACHE_TTL
+    ):
+        return entry["country"]
+
+    team_info = fetch_team_info(team_id, http_cache)
+    country = team_info.get("country")
+    if not country:
+        print("Team info did not contain country", file=sys.stderr)
+        sys.exit(1)
 
-    except requests.exceptions.RequestException as e:
+    country = country.lower()
+    cache[str(team_id)] = {"country": country, "fetched_at": int(time.time())}
+    save_country_cache(cache)
+    return country
+
+
+def leaderboard_map(teams):
+    # Keep only the fields generate_message uses, keyed by team ID and in place
+    # order, which generate_message relies on. The sort is stable, so teams that
+    # share a place keep the order they were given in
+    teams = sorted(teams, key=lambda t: t["country_place"])
+    return {
+        t["team_id"]: {
+            "team_id": t["team_id"],
+            "team_name": t["team_name"],
+            "country_place": t["country_place"],
+            "points": t.get("points", 0.0),
+        }
+        for t in teams
+    }
+
+
+def fetch_leaderboard(api_url: str, http_cache):
+    # Only ask for a 304 if there is a saved leaderboard for main() to reuse
+    entry = http_cache.get("leaderboard")
+    headers = conditional_headers(entry, api_url) if LEADERBOARD_FILE.exists() else {}
+
+    try:
+        response = SESSION.get(api_url, headers=headers)
+        status = response.status_code
+        if status == 304:
+            return NOT_MODIFIED
+        if not 200 <= status < 300:
+            print(f"Failed to fetch leaderboard: HTTP {status}", file=sys.stderr)
+            sys.exit(1)
+        data = orjson.loads(response.content)
+
+        http_cache["leaderboard"] = cache_entry(response, api_url)
+        return leaderboard_map(data)
+
+    except httpx.RequestError as e:
         print(f"Failed to fetch leaderboard: {e}", file=sys.stderr)
         sys.exit(1)
 
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"Failed to decode leaderboard JSON: {e}", file=sys.stderr)
         sys.exit(1)
 
 
 def load_old_leaderboard():
-    if not LEADERBOARD_FILE.exists():
-        return None
     try:
-        return json.loads(LEADERBOARD_FILE.read_text(encoding="utf-8"))
-    except (json.JSONDecodeError, IOError) as e:
+        if LEADERBOARD_FILE.exists():
+            data = ZSTD_DECOMPRESSOR.decompress(LEADERBOARD_FILE.read_bytes())
+        elif LEGACY_LEADERBOARD_FILE.exists():
+            data = LEGACY_LEADERBOARD_FILE.read_bytes()
+        else:
+            return None
+        return leaderboard_map(orjson.loads(data))
+    except (orjson.JSONDecodeError, zstd.ZstdError, IOError) as e:
         print(f"Could not load old leaderboard file: {e}", file=sys.stderr)
         sys.exit(1)
 
 
 def save_new_leaderboard(leaderboard):
+    # Write to a temp file and swap it in, so a crash never leaves a truncated file
+    tmp = LEADERBOARD_FILE.with_name(LEADERBOARD_FILE.name + ".tmp")
     try:
-        LEADERBOARD_FILE.write_text(json.dumps(leaderboard, indent=2), encoding="utf-8")
+        tmp.write_bytes(
+            ZSTD_COMPRESSOR.compress(orjson.dumps(list(leaderboard.values())))
+        )
+        os.replace(tmp, LEADERBOARD_FILE)
+        LEGACY_LEADERBOARD_FILE.unlink(missing_ok=True)
     except IOError as e:
         print(f"Failed to save leaderboard: {e}", file=sys.stderr)
         sys.exit(1)
 
 
+def leaderboard_hash(leaderboard):
+    data = orjson.dumps(list(leaderboard.values()), option=orjson.OPT_SORT_KEYS)
+    return xxhash.xxh3_64(data).hexdigest()
+
+
+def load_leaderboard_hash():
+    try:
+        return HASH_FILE.read_text(encoding="utf-8").strip()
+    except IOError:
+        return None
+
+
+def save_leaderboard_hash(digest: str):
+    tmp = HASH_FILE.with_name(HASH_FILE.name + ".tmp")
+    try:
+        tmp.write_text(digest, encoding="utf-8")
+        os.replace(tmp, HASH_FILE)
+    except IOError as e:
+        print(f"Failed to save leaderboard hash: {e}", file=sys.stderr)
+        # A stale hash could later match and hide a real change, so drop it
+        try:
+            HASH_FILE.unlink(missing_ok=True)
+        except IOError as e:
+            print(f"Failed to remove stale leaderboard hash: {e}", file=sys.stderr)
+
+
 def escape_markdown(text: str):
-    return re.sub(r"([\\`*_{}\[\]()#+\-.!])", r"\\\1", text)
+    return text.translate(MARKDOWN_ESCAPES)
 
 
-def format_team_name(team, use_link=True, include_points=False):
-    name = escape_markdown(team["team_name"])
+@lru_cache(maxsize=2048)
+def _format_team_name(
+    team_id: int, team_name: str, points: float, use_link: bool, include_points: bool
+):
+    name = escape_markdown(team_name)
 
     if include_points:
-        name += f" ({team['points']:.2f} p)"
+        name += f" ({points:.2f} p)"
 
     if use_link:
-        url = TEAM_PAGE_URL_TEMPLATE.format(team_id=team["team_id"])
+        url = TEAM_PAGE_URL_TEMPLATE.format(team_id=team_id)
         name = f"[{name}](<{url}>)"
 
     return name
 
 
+def format_team_name(team, use_link=True, include_points=False):
+    return _format_team_name(
+        team["team_id"],
+        team["team_name"],
+        team.get("points", 0.0),
+        use_link,
+        include_points,
+    )
+
+
 def format_team_list(team_ids, team_map, use_link=True, include_points=False):
     if not team_ids:
         return ""
@@ -129,12 +338,15 @@ def format_team_list(team_ids, team_map, use_link=True, include_points=False):
     if len(formatted) == 1:
         return formatted[0]
 
-    return ", ".join(formatted[:-1]) + " og " + formatted[-1]
+    # pop() the last name instead of slicing off the rest
+    last = formatted.pop()
+    return f"{', '.join(formatted)} og {last}"
 
 
 def generate_message(old, new, tracked_team_id):
-    new_map = {t["team_id"]: t for t in new} if new else {}
-    old_map = {t["team_id"]: t for t in old} if old else {}
+    # Both leaderboards arrive already keyed by team ID
+    new_map = new or {}
+    old_map = old or {}
 
     if tracked_team_id not in new_map:
         if tracked_team_id in old_map:
@@ -153,19 +365,29 @@ def generate_message(old, new, tracked_team_id):
 
     old_place = old_map[tracked_team_id]["country_place"]
 
-    passed_ids = []
+    # Only teams now ahead of us can have overtaken us, and only teams that were
+    # not behind us can have been passed. Both maps are in place order, so walk
+    # each one just until we reach our own place instead of the whole country
     overtaken_ids = []
+    for t_id, team in new_map.items():
+        if team["country_place"] >= new_place:
+            break
+        if t_id in old_map and old_map[t_id]["country_place"] >= old_place:
+            overtaken_ids.append(t_id)
 
-    for t_id, new_team in new_map.items():
-        if t_id == tracked_team_id or t_id not in old_map:
-            continue
-
-        old_t_place = old_map[t_id]["country_place"]
-        new_t_place = new_team["country_place"]
+    passed = set()
+    for t_id, team in old_map.items():
+        if team["country_place"] > old_place:
+            break
+        if t_id in new_map and new_map[t_id]["country_place"] > new_place:
+            passed.add(t_id)
 
-        if new_t_place < new_place and old_t_place >= old_place:
-            overtaken_ids.append(t_id)
-        elif new_t_place > new_place and old_t_place <= old_place:
+    # List them in new leaderboard order, stopping once the last one is found
+    passed_ids = []
+    for t_id in new_map:
+        if len(passed_ids) == len(passed):
+            break
+        if t_id in passed:
             passed_ids.append(t_id)
 
     passed_str = format_team_list(passed_ids, new_map, USE_LINKS, INCLUDE_POINTS)
@@ -219,9 +441,8 @@ def generate_message(old, new, tracked_team_id):
 
 def send_webhook(message: str):
     try:
-        r = requests.post(
+        r = SESSION.post(
             WEBHOOK_URL,
-            timeout=30,
             json={
                 "masquerade": {
                     "name": "CTFtime-vakta",
@@ -230,33 +451,56 @@ def send_webhook(message: str):
                 "content": message,
             },
         )
-        r.raise_for_status()
-        print("Webhook sent successfully!")
-    except requests.exceptions.RequestException as e:
+    except httpx.RequestError as e:
         print(f"Failed to send webhook: {e}", file=sys.stderr)
+        return False
+
+    if not 200 <= r.status_code < 300:
+        print(f"Failed to send webhook: HTTP {r.status_code}", file=sys.stderr)
+        return False
+
+    print("Webhook sent successfully!")
+    return True
 
 
 def main():
-    team_info = fetch_team_info(TEAM_ID)
-    country = team_info.get("country")
-    if not country:
-        print("Team info did not contain country", file=sys.stderr)
-        sys.exit(1)
+    http_cache = load_http_cache()
 
-    country = country.lower()
-    api_url = LEADERBOARD_URL_TEMPLATE.format(country=country)
+    # Reading the old leaderboard doesn't depend on the requests, so overlap them
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        old_future = executor.submit(load_old_leaderboard)
+
+        country = get_team_country(TEAM_ID, http_cache)
+        api_url = LEADERBOARD_URL_TEMPLATE.format(country=country)
+
+        new_future = executor.submit(fetch_leaderboard, api_url, http_cache)
+        old_leaderboard = old_future.result()
+        new_leaderboard = new_future.result()
+
+    # The saved leaderboard holds the projected form, so it doubles as the 304 body
+    if new_leaderboard is NOT_MODIFIED:
+        new_leaderboard = old_leaderboard
 
-    old_leaderboard = load_old_leaderboard()
-    new_leaderboard = fetch_leaderboard(api_url)
+    new_hash = leaderboard_hash(new_leaderboard)
+    if old_leaderboard is not None and new_hash == load_leaderboard_hash():
+        print("Leaderboard unchanged since last run. Skipping webhook.")
+        # The saved leaderboard already matches, so fresh validators are still valid
+        save_http_cache(http_cache)
+        return
 
     message = generate_message(old_leaderboard, new_leaderboard, TEAM_ID)
 
     if message:
-        send_webhook(message)
+        if not send_webhook(message):
+            # Keep the old snapshot so the next run reports this change again
+            return
     else:
         print("No significant change in leaderboard detected. Skipping webhook.")
 
     save_new_leaderboard(new_leaderboard)
+    save_leaderboard_hash(new_hash)
+    # Only persist validators once the saved leaderboard matches their response
+    save_http_cache(http_cache)
 
 
 if __name__ == "__main__":